@@ -12,7 +12,10 @@ from difflib import get_close_matches
 from discord.ext.commands import MissingRequiredArgument
 import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import jobs
+import ledger
 
 
 # Setup logging for better debugging and monitoring
@@ -108,11 +111,10 @@ def extract_transaction_details(claude_response):
         logging.error(f"Error extracting transaction details: {str(e)}")
         return None, None, None
 
-# Function to log payment to Google Sheets with a serial number
-def log_payment_to_sheet(serial_number, user, payment_date, amount, log_date, cover_date, next_rent_date):
+# Function to log payment to Google Sheets with the next free serial number (must hold the ledger write lock)
+def log_payment_to_sheet(user, payment_date, amount, log_date, cover_date, next_rent_date):
     try:
-        worksheet.append_row([
-            serial_number, 
+        serial_number = ledger.append_receipt(worksheet, [
             user, 
             payment_date.strftime('%Y-%m-%d'), 
             f"${amount:.2f}", 
@@ -124,25 +126,79 @@ def log_payment_to_sheet(serial_number, user, payment_date, amount, log_date, co
     except Exception as e:
         logging.error(f"Failed to log payment: {str(e)}")
         return "Failed to log payment due to an error."
-    
-#change usernames
-@bot.command()
-async def update_names(ctx):
-    try:
-        # Fetch all records from the sheet
-        all_records = worksheet.get_all_records()
 
-        # Iterate through each record and check for the user to replace
-        for i, record in enumerate(all_records, start=2):  # Start from 2 because row 1 is the header
-            if record['Paid By'] == "heheboi_2024":
-                worksheet.update_cell(i, 2, "SonamKhadka")  # Update the 'Paid By' column to "SonamKhadka"
-            elif record['Paid By'] == "siru0785":
-                worksheet.update_cell(i, 2, "SrijanaKattel")  # Update the 'Paid By' column to "SrijanaKattel"
 
-        await ctx.send("Usernames updated successfully.")
+# Ledger access layer (see ledger.py)
+# The lock is created in setup_hook so it belongs to the bot's event loop
+ledger_lock = None
+
+# Function to run a blocking sheet function in a thread while holding the ledger lock
+async def run_ledger(access, func, *args, **kwargs):
+    return await ledger.run_ledger(ledger_lock, access, func, *args, **kwargs)
+
+# Function to apply a ledger change (e.g. ledger.delete_receipt_row) to a receipt by serial number or payment date
+async def change_receipt(change, args=(), serial_number=None, payment_date=None, retry=False):
+    return await ledger.change_receipt(ledger_lock, worksheet, change, args, serial_number=serial_number, payment_date=payment_date, retry=retry)
+
+# Function for job threads to run a sheet function under the ledger lock on the bot's event loop
+# Jobs call this per sheet call (or batch of writes) so quick commands can get the lock in between.
+def run_ledger_from_thread(access, func, *args, **kwargs):
+    return asyncio.run_coroutine_threadsafe(run_ledger(access, func, *args, **kwargs), bot.loop).result()
+
+# Function to find any cell matching a query and return the values of its row
+def find_row_values(query):
+    cell = worksheet.find(query)
+    return worksheet.row_values(cell.row) if cell else None
 
-    except Exception as e:
-        await ctx.send(f"Error updating names: {str(e)}")
+
+# Job queue setup (see jobs.py)
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 10))
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job-worker")
+job_queue = None  # Created in setup_hook so it belongs to the bot's event loop
+
+# Function to queue a blocking job and reply with its job ID (see jobs.JobQueue.submit)
+async def submit_job(ctx, description, func, *args, deliver=None):
+    return await job_queue.submit(ctx, description, func, *args, deliver=deliver)
+
+@bot.event
+async def setup_hook():
+    global job_queue, ledger_lock
+    job_queue = jobs.JobQueue(JOB_WORKERS, JOB_QUEUE_SIZE, job_executor)
+    ledger_lock = ledger.ReadWriteLock()
+    # Make sure the version column has a header so get_all_records keeps working
+    await run_ledger('write', ledger.ensure_version_header, worksheet)
+    job_queue.start()
+    
+#change usernames (runs as a job, called from the worker thread)
+RENAME_BATCH_SIZE = 25
+
+def update_names_in_sheet(progress):
+    # Fetch all rows from the sheet, skipping the header
+    all_rows = run_ledger_from_thread('read', worksheet.get_all_values)[1:]
+    new_names = {"heheboi_2024": "SonamKhadka", "siru0785": "SrijanaKattel"}
+
+    # Collect the receipts whose 'Paid By' needs replacing, with the version we read
+    renames = [
+        (row[ledger.SERIAL_NUMBER_COL], ledger.row_version(row), new_names[row[ledger.PAID_BY_COL]])
+        for row in all_rows if row[ledger.SERIAL_NUMBER_COL] and row[ledger.PAID_BY_COL] in new_names
+    ]
+
+    # Write in batches so the write lock is only held for one batch_update at a time
+    renamed = skipped = 0
+    for start in range(0, len(renames), RENAME_BATCH_SIZE):
+        batch_renamed, batch_skipped = run_ledger_from_thread('write', ledger.rename_payers, worksheet, renames[start:start + RENAME_BATCH_SIZE])
+        renamed += batch_renamed
+        skipped += batch_skipped
+        progress(f"updating names ({renamed + skipped}/{len(renames)} receipts)")
+
+    if skipped:
+        return f"Usernames updated on {renamed} receipts. {skipped} receipts were changed or deleted by another command and were skipped; run `!update_names` again to retry them."
+    return "Usernames updated successfully."
+
+@bot.command()
+async def update_names(ctx):
+    await submit_job(ctx, "updating usernames", update_names_in_sheet)
 
 
 # Command to log rent payments with optional manual payment date
@@ -169,16 +225,12 @@ async def log_payment(ctx, amount: float = None, payment_date: str = None):
         else:
             payment_date = log_date
 
-        # Get all receipts to determine the next serial number
-        all_receipts = worksheet.get_all_records()
-        serial_number = len(all_receipts) + 1
-
         # Calculate the next due date and cover date
         next_due_date = (payment_date + timedelta(days=14))
         cover_date = (payment_date - timedelta(days=14))
 
-        # Log the payment
-        log_message = log_payment_to_sheet(serial_number, user_name, payment_date, amount, log_date, cover_date, next_due_date)
+        # Log the payment; the serial number is picked under the write lock so concurrent logs can't collide
+        log_message = await run_ledger('write', log_payment_to_sheet, user_name, payment_date, amount, log_date, cover_date, next_due_date)
         
         await ctx.send(log_message)
         await ctx.send(f"Your next payment is due on {next_due_date.strftime('%d/%m/%Y')}.")
@@ -192,34 +244,7 @@ async def log_payment(ctx, amount: float = None, payment_date: str = None):
 @bot.command()
 async def show_receipt(ctx, identifier: str):
     try:
-        # Get all rows, skipping the header
-        all_rows = worksheet.get_all_values()[1:]
-
-        SERIAL_NUMBER_COL = 0
-        PAYMENT_DATE_COL = 2
-
-        # Attempt to treat the identifier as a serial number
-        try:
-            serial_number = int(identifier)
-            for row in all_rows:
-                if row[SERIAL_NUMBER_COL] == str(serial_number):
-                    await ctx.send(f"Receipt for {row[1]}: Serial Number: {serial_number}, Payment Date: {row[PAYMENT_DATE_COL]}, Amount: {row[3]}")
-                    return
-            await ctx.send(f"No receipt found with serial number {serial_number}.")
-        
-        except ValueError:
-            try:
-                payment_date = datetime.strptime(identifier, '%d/%m/%Y').strftime('%Y-%m-%d')
-            except ValueError:
-                await ctx.send("Invalid input. Please provide a valid serial number or a date in DD/MM/YYYY format.")
-                return
-
-            for row in all_rows:
-                if row[PAYMENT_DATE_COL] == payment_date:
-                    await ctx.send(f"Receipt for {row[1]}: Serial Number: {row[0]}, Payment Date: {row[PAYMENT_DATE_COL]}, Amount: {row[3]}")
-                    return
-            await ctx.send(f"No receipt found for {payment_date}.")
-    
+        await ctx.send(await run_ledger('read', ledger.describe_receipt, worksheet, identifier))
     except Exception as e:
         logging.error(f"Error in show_receipt: {str(e)}")
         await ctx.send(f"Error: {str(e)}")
@@ -233,10 +258,8 @@ async def edit_receipt(ctx, identifier: str, new_amount: float):
         # Try to treat the identifier as a serial number first
         try:
             serial_number = int(identifier)
-            cell = worksheet.find(str(serial_number))
             
-            if cell:
-                worksheet.update_cell(cell.row, 4, new_amount)  # Assuming column 4 is the amount
+            if await change_receipt(ledger.update_receipt_amount, (new_amount,), serial_number=serial_number):
                 await ctx.send(f"Receipt with serial number {serial_number} updated to new amount: ${new_amount}")
             else:
                 await ctx.send(f"No receipt found with serial number {serial_number}.")
@@ -249,12 +272,13 @@ async def edit_receipt(ctx, identifier: str, new_amount: float):
                 await ctx.send("Invalid input. Please provide either a valid serial number or a date in the format DD/MM/YYYY.")
                 return
 
-            cell = worksheet.find(payment_date)
-            if cell:
-                worksheet.update_cell(cell.row, 4, new_amount)
+            if await change_receipt(ledger.update_receipt_amount, (new_amount,), payment_date=payment_date):
                 await ctx.send(f"Receipt for {payment_date} updated to new amount: ${new_amount}")
             else:
                 await ctx.send(f"No receipt found for {payment_date}.")
+    except ledger.LedgerConflict as e:
+        # Another command changed the receipt after we read it, so don't overwrite their edit
+        await ctx.send(f"{str(e)} Please check it with `!show_receipt` and try again.")
     except Exception as e:
         await ctx.send(f"Error: {str(e)}")
 
@@ -271,10 +295,9 @@ async def show_detailed_receipt(ctx, identifier: str = None):
         # Try to treat the identifier as a serial number first
         try:
             serial_number = int(identifier)
-            cell = worksheet.find(str(serial_number))
+            row = await run_ledger('read', find_row_values, str(serial_number))
             
-            if cell:
-                row = worksheet.row_values(cell.row)
+            if row:
                 serial_number, payment_date, cover_date, amount, user = row
                 await ctx.send(f"Receipt for {user}: Serial Number: {serial_number}, Payment Date: {payment_date}, Cover Date: {cover_date}, Amount: ${amount}")
             else:
@@ -288,9 +311,8 @@ async def show_detailed_receipt(ctx, identifier: str = None):
                 await ctx.send("Invalid input. Please provide either a valid serial number or a date in the format DD/MM/YYYY.")
                 return
 
-            cell = worksheet.find(payment_date)
-            if cell:
-                row = worksheet.row_values(cell.row)
+            row = await run_ledger('read', find_row_values, payment_date)
+            if row:
                 user, payment_date, cover_date, amount = row
                 await ctx.send(f"Receipt for {user}: Payment Date: {payment_date}, Cover Date: {cover_date}, Amount: ${amount}")
             else:
@@ -308,11 +330,8 @@ async def delete_receipt(ctx, identifier: str):
         # First, try to treat the identifier as a serial number
         try:
             serial_number = int(identifier)
-            # Find the row that contains the serial number
-            cell = worksheet.find(str(serial_number))  # Assuming serial number is stored as a string
-            
-            if cell:
-                worksheet.delete_rows(cell.row)
+            # Delete by serial number so a concurrent delete can't shift the row under us
+            if await change_receipt(ledger.delete_receipt_row, serial_number=serial_number, retry=True):
                 await ctx.send(f"Receipt with serial number {serial_number} deleted successfully.")
             else:
                 await ctx.send(f"No receipt found with serial number {serial_number}.")
@@ -325,15 +344,16 @@ async def delete_receipt(ctx, identifier: str):
                 await ctx.send("Invalid input. Please provide either a valid serial number or a date in the format DD/MM/YYYY.")
                 return
 
-            # Find the row that contains the payment date
-            cell = worksheet.find(payment_date)
-
-            if cell:
-                worksheet.delete_rows(cell.row)
-                await ctx.send(f"Receipt for {payment_date} deleted successfully.")
+            # Find the receipt with that payment date and delete it by serial number
+            serial_number = await change_receipt(ledger.delete_receipt_row, payment_date=payment_date, retry=True)
+            if serial_number:
+                await ctx.send(f"Receipt for {payment_date} (serial number {serial_number}) deleted successfully.")
             else:
                 await ctx.send(f"No receipt found for {payment_date}.")
     
+    except ledger.LedgerConflict as e:
+        # The receipt we read was deleted by another command before we got to it
+        await ctx.send(str(e))
     except Exception as e:
         await ctx.send(f"Error: {str(e)}")
 
@@ -365,30 +385,26 @@ async def ask_ai(ctx, *, question: str):
         date = date_match.group(1)
         # Check if payment exists in logs
         try:
-            cell = worksheet.find(date)
-            if cell:
-                row = worksheet.row_values(cell.row)
+            row = await run_ledger('read', find_row_values, date)
+            if row:
                 user, payment_date, cover_date, amount = row
                 await ctx.send(f"Yes, a payment of ${amount} was logged for {user} on {payment_date}.")
-            else:
-                # Ask Claude if no entry is found, include bot commands prompt
-                response = ask_claude_with_bot_integration(question, bot_commands_prompt)
-                if response:  # Check if Claude's response is not empty
-                    await ctx.send(response)
-                else:
-                    await ctx.send("I couldn't find any relevant information.")
+                return
         except Exception as e:
             await ctx.send(f"Error while checking logs: {str(e)}")
-    else:
-        try:
-            # Fallback to Claude if no date was found, include bot commands prompt
-            response = ask_claude_with_bot_integration(question, bot_commands_prompt)
-            if response:
-                await ctx.send(response)
-            else:
-                await ctx.send("I couldn't find any relevant information.")
-        except Exception as e:
-            await ctx.send(f"Error: {str(e)}")
+            return
+
+    # The Claude call is slow, so run it as a job (without the ledger lock, so writes aren't held up)
+    await submit_job(ctx, "asking Claude", answer_question, question, bot_commands_prompt)
+
+# Function to answer an ask_ai question with Claude (runs as a job, called from the worker thread)
+def answer_question(question, bot_commands_prompt, progress):
+    # Ask Claude if no date or entry was found, include bot commands prompt
+    progress("waiting for Claude")
+    response = ask_claude_with_bot_integration(question, bot_commands_prompt)
+    if response:  # Check if Claude's response is not empty
+        return response
+    return "I couldn't find any relevant information."
 
 def ask_claude_with_bot_integration(question, bot_commands_prompt):
     # Combine the question with the bot's command capabilities
@@ -418,9 +434,8 @@ async def show_receipt_details(ctx, payment_date: str = None):
     
     # Now, proceed to check the payment logs
     try:
-        cell = worksheet.find(payment_date)
-        if cell:
-            row = worksheet.row_values(cell.row)
+        row = await run_ledger('read', find_row_values, payment_date)
+        if row:
             user, payment_date, cover_date, amount = row
             await ctx.send(f"Receipt for {user}: Payment Date: {payment_date}, Cover Date: {cover_date}, Amount: ${amount}")
         else:
@@ -483,25 +498,33 @@ async def show_receipts_range(ctx, start_date: str, end_date: str):
         # Convert start and end dates to datetime objects
         start_date_dt = datetime.strptime(start_date, '%d/%m/%Y')
         end_date_dt = datetime.strptime(end_date, '%d/%m/%Y')
-        
-        all_receipts = worksheet.get_all_records()  # Retrieve all records
-        filtered_receipts = []
-
-        # Filter receipts based on the date range
-        for receipt in all_receipts:
-            receipt_date_dt = datetime.strptime(receipt['payment_date'], '%Y-%m-%d')
-            if start_date_dt <= receipt_date_dt <= end_date_dt:
-                filtered_receipts.append(receipt)
-
-        if filtered_receipts:
-            receipt_message = f"Receipts from {start_date} to {end_date}:\n"
-            for receipt in filtered_receipts:
-                receipt_message += f"User: {receipt['user']}, Payment Date: {receipt['payment_date']}, Amount: {receipt['amount']}\n"
-            await ctx.send(receipt_message)
-        else:
-            await ctx.send(f"No receipts found between {start_date} and {end_date}.")
-    except Exception as e:
-        await ctx.send(f"Error: {str(e)}")
+    except ValueError:
+        await ctx.send("Invalid date format. Please use DD/MM/YYYY.")
+        return
+
+    await submit_job(ctx, f"exporting receipts from {start_date} to {end_date}", build_receipts_range, start_date_dt, end_date_dt)
+
+# Function to list receipts within a date range (runs as a job, called from the worker thread)
+def build_receipts_range(start_date_dt, end_date_dt, progress):
+    start_date = start_date_dt.strftime('%d/%m/%Y')
+    end_date = end_date_dt.strftime('%d/%m/%Y')
+
+    all_receipts = run_ledger_from_thread('read', worksheet.get_all_records)  # Retrieve all records
+    progress(f"filtering {len(all_receipts)} receipts")
+    filtered_receipts = []
+
+    # Filter receipts based on the date range
+    for receipt in all_receipts:
+        receipt_date_dt = datetime.strptime(receipt['payment_date'], '%Y-%m-%d')
+        if start_date_dt <= receipt_date_dt <= end_date_dt:
+            filtered_receipts.append(receipt)
+
+    if filtered_receipts:
+        receipt_message = f"Receipts from {start_date} to {end_date}:\n"
+        for receipt in filtered_receipts:
+            receipt_message += f"User: {receipt['user']}, Payment Date: {receipt['payment_date']}, Amount: {receipt['amount']}\n"
+        return receipt_message
+    return f"No receipts found between {start_date} and {end_date}."
 # Starting due date (20/09/2024)
 initial_due_date = datetime.strptime('20/09/2024', '%d/%m/%Y')
 
@@ -534,7 +557,7 @@ async def send_fortnightly_reminder(channel):
     due_date = get_next_due_date()  # Start with the initial due date
     while True:
         # Check if the payment has been logged
-        if is_payment_logged():
+        if await run_ledger('read', is_payment_logged):
             await channel.send(f"Thank you! The rent payment has been logged.")
             break  # Stop reminding once payment is logged
         else:
@@ -547,26 +570,32 @@ async def send_fortnightly_reminder(channel):
         # Wait 24 hours before sending the next reminder
         await asyncio.sleep(86400)  # Remind every 24 hours
 
-# Example of the send_fortnightly_report function
-async def send_fortnightly_report():
-    while True:
-        # Fetch all receipts from Google Sheets or database
-        all_receipts = worksheet.get_all_records()
-        today = datetime.now()
+# Function to build the fortnightly report (called from the worker thread)
+def build_fortnightly_report():
+    # Fetch all receipts from Google Sheets or database
+    all_receipts = worksheet.get_all_records()
+    today = datetime.now()
 
-        # Generate a report for the past two weeks
-        start_date = (today - timedelta(weeks=2)).strftime('%Y-%m-%d')
-        report_message = f"Fortnightly Report (from {start_date} to {today.strftime('%Y-%m-%d')}):\n"
-        total_amount = 0
+    # Generate a report for the past two weeks
+    start_date = (today - timedelta(weeks=2)).strftime('%Y-%m-%d')
+    report_message = f"Fortnightly Report (from {start_date} to {today.strftime('%Y-%m-%d')}):\n"
+    total_amount = 0
 
-        # Iterate through the receipts and filter them by the date range
-        for receipt in all_receipts:
-            receipt_date = receipt['Payment Date']
-            if start_date <= receipt_date <= today.strftime('%Y-%m-%d'):
-                report_message += f"User: {receipt['Paid By']}, Date: {receipt_date}, Amount: {receipt['Amount']}\n"
-                total_amount += float(receipt['Amount'].replace('$', '').replace(',', ''))  # Convert amount to a float
+    # Iterate through the receipts and filter them by the date range
+    for receipt in all_receipts:
+        receipt_date = receipt['Payment Date']
+        if start_date <= receipt_date <= today.strftime('%Y-%m-%d'):
+            report_message += f"User: {receipt['Paid By']}, Date: {receipt_date}, Amount: {receipt['Amount']}\n"
+            total_amount += float(receipt['Amount'].replace('$', '').replace(',', ''))  # Convert amount to a float
 
-        report_message += f"\nTotal amount paid: ${total_amount}"
+    report_message += f"\nTotal amount paid: ${total_amount}"
+    return report_message
+
+# Example of the send_fortnightly_report function
+async def send_fortnightly_report():
+    while True:
+        # Build the report in a thread so the gateway loop isn't blocked by the sheet read
+        report_message = await run_ledger('read', build_fortnightly_report)
 
         # Fetch the report channel from the ID stored in .env for reports and requests
         REPORT_CHANNEL_ID = int(os.getenv('REPORT_CHANNEL_ID'))  # Ensure the ID is in .env
@@ -582,25 +611,29 @@ async def send_fortnightly_report():
         await asyncio.sleep(1209600)
 
 
-@bot.command()
-async def request_report(ctx, destination: str = "channel"):
-    try:
-        all_receipts = worksheet.get_all_records()  # Fetch all receipts
-        today = datetime.now()
+# Function to build a requested report (runs as a job, called from the worker thread)
+def build_requested_report(progress):
+    all_receipts = run_ledger_from_thread('read', worksheet.get_all_records)  # Fetch all receipts
+    progress(f"building report from {len(all_receipts)} receipts")
+    today = datetime.now()
 
-        # Generate the report for the past two weeks
-        start_date = (today - timedelta(weeks=2)).strftime('%Y-%m-%d')
-        report_message = f"Requested Report (from {start_date} to {today.strftime('%Y-%m-%d')}):\n"
-        total_amount = 0
+    # Generate the report for the past two weeks
+    start_date = (today - timedelta(weeks=2)).strftime('%Y-%m-%d')
+    report_message = f"Requested Report (from {start_date} to {today.strftime('%Y-%m-%d')}):\n"
+    total_amount = 0
 
-        for receipt in all_receipts:
-            receipt_date = receipt['payment_date']
-            if start_date <= receipt_date <= today.strftime('%Y-%m-%d'):
-                report_message += f"User: {receipt['user']}, Date: {receipt_date}, Amount: {receipt['amount']}\n"
-                total_amount += float(receipt['amount'])
+    for receipt in all_receipts:
+        receipt_date = receipt['payment_date']
+        if start_date <= receipt_date <= today.strftime('%Y-%m-%d'):
+            report_message += f"User: {receipt['user']}, Date: {receipt_date}, Amount: {receipt['amount']}\n"
+            total_amount += float(receipt['amount'])
 
-        report_message += f"\nTotal rent paid: ${total_amount}"
+    report_message += f"\nTotal rent paid: ${total_amount}"
+    return report_message
 
+@bot.command()
+async def request_report(ctx, destination: str = "channel"):
+    async def deliver_report(report_message):
         # If the user wants the report in their DMs
         if destination.lower() == "dm":
             await ctx.author.send(report_message)
@@ -614,9 +647,8 @@ async def request_report(ctx, destination: str = "channel"):
                 await report_channel.send(report_message)
             else:
                 print("Error: Report channel not found or invalid ID")
-                
-    except Exception as e:
-        await ctx.send(f"Error generating report: {str(e)}")
+
+    await submit_job(ctx, "generating report", build_requested_report, deliver=deliver_report)
         
 async def send_trash_reminders():
     # Get the channel ID from the .env file
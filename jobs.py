@@ -0,0 +1,101 @@
+
+import asyncio
+import functools
+import itertools
+import logging
+
+
+# Job queue
+# Heavy work (reports, bulk edits, exports, Claude calls) is queued and run in a thread pool
+# so the event loop that keeps the Discord gateway alive only parses commands and sends replies.
+# Jobs take the ledger lock only around their own sheet calls, not for their whole run.
+
+# Bounded queue of jobs with worker tasks that run them in a thread pool
+class JobQueue:
+    def __init__(self, workers, maxsize, executor):
+        self.workers = workers
+        self.executor = executor
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._ids = itertools.count(1)
+
+    # Function to start the worker tasks on the running event loop
+    def start(self):
+        loop = asyncio.get_running_loop()
+        return [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    # Function to wait until every queued job has finished
+    async def join(self):
+        await self._queue.join()
+
+    # Function to queue a blocking job and reply with its job ID
+    # `func` runs in the thread pool and is called as func(*args, progress=progress); its return value
+    # is passed to `deliver` (defaults to replying in the channel the command came from).
+    # Returns the job ID, or None if the queue was full.
+    async def submit(self, ctx, description, func, *args, deliver=None):
+        # Backpressure: refuse new work instead of letting the backlog grow without bound
+        if self._queue.full():
+            await ctx.send(f"The bot is busy with {self._queue.qsize()} queued jobs. Please try `{ctx.message.content}` again shortly.")
+            return None
+
+        # Take the queue slot before any await so concurrent commands can't overfill the queue;
+        # the worker waits for the status message before starting the job
+        job = {
+            'id': next(self._ids),
+            'description': description,
+            'func': func,
+            'args': args,
+            'deliver': deliver or ctx.send,
+            'status_message': asyncio.get_running_loop().create_future(),
+        }
+        self._queue.put_nowait(job)
+
+        try:
+            status_message = await ctx.send(f"Job #{job['id']} queued: {description} (position {self._queue.qsize()}).")
+        except Exception as e:
+            job['status_message'].set_exception(e)
+            raise
+        job['status_message'].set_result(status_message)
+        return job['id']
+
+    # Function to edit a job's status message without letting Discord errors (e.g. a deleted message) kill the worker
+    async def _update_status(self, job, status_message, text):
+        try:
+            await status_message.edit(content=f"Job #{job['id']} {text}")
+        except Exception as e:
+            logging.warning(f"Could not update status for job #{job['id']}: {str(e)}")
+
+    # Worker task: pulls jobs off the queue and runs them in the thread pool
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(loop, job)
+            finally:
+                self._queue.task_done()
+
+    # Function to run one job and report its progress and outcome in its status message
+    async def _run(self, loop, job):
+        try:
+            status_message = await job['status_message']
+        except Exception as e:
+            logging.error(f"Job #{job['id']} ({job['description']}) dropped: its status message could not be sent: {str(e)}")
+            return
+
+        pending_updates = []
+
+        def progress(text):
+            # Called from the worker thread, so hand the edit back to the event loop
+            pending_updates.append(asyncio.run_coroutine_threadsafe(self._update_status(job, status_message, f"running: {text}"), loop))
+
+        try:
+            await self._update_status(job, status_message, f"running: {job['description']}...")
+            result = await loop.run_in_executor(self.executor, functools.partial(job['func'], *job['args'], progress=progress))
+            # Let in-flight progress edits land before the final status so they can't overwrite it
+            await asyncio.gather(*(asyncio.wrap_future(f) for f in pending_updates), return_exceptions=True)
+            await job['deliver'](result)
+            await self._update_status(job, status_message, f"done: {job['description']}.")
+        except Exception as e:
+            logging.error(f"Job #{job['id']} ({job['description']}) failed: {str(e)}")
+            await asyncio.gather(*(asyncio.wrap_future(f) for f in pending_updates), return_exceptions=True)
+            await self._update_status(job, status_message, f"failed: {str(e)}")
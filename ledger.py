@@ -0,0 +1,191 @@
+
+import asyncio
+import contextlib
+import functools
+import logging
+from datetime import datetime
+
+
+# Ledger access layer
+# Commands run concurrently, so every sheet access goes through a ReadWriteLock: reads share it and
+# writes are serialized. Each row carries a version, and edits/deletes are applied by serial number
+# and rejected with LedgerConflict if the row changed after it was read.
+# The sheet functions are blocking and take the worksheet as a parameter; run them with run_ledger.
+SERIAL_NUMBER_COL = 0
+PAID_BY_COL = 1
+PAYMENT_DATE_COL = 2
+AMOUNT_COL = 3
+VERSION_COL = 7
+
+# Exception raised when a receipt was changed or deleted by another command after it was read
+class LedgerConflict(Exception):
+    pass
+
+# Async reader/writer lock: readers share it, writers hold it alone, and a waiting writer
+# blocks new readers so a steady stream of reads can't starve it
+class ReadWriteLock:
+    def __init__(self):
+        self._condition = asyncio.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+
+    @contextlib.asynccontextmanager
+    async def read(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._writing and not self._waiting_writers)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._readers -= 1
+                self._condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def write(self):
+        async with self._condition:
+            self._waiting_writers += 1
+            try:
+                await self._condition.wait_for(lambda: not self._writing and not self._readers)
+            finally:
+                self._waiting_writers -= 1
+                # Wake readers held back by this writer if it was cancelled while waiting
+                self._condition.notify_all()
+            self._writing = True
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+# Context manager for taking the ledger lock ('read' or 'write')
+@contextlib.asynccontextmanager
+async def ledger_access(lock, access):
+    if access not in ('read', 'write'):
+        raise ValueError(f"Unknown ledger access {access!r}; expected 'read' or 'write'.")
+    async with (lock.write() if access == 'write' else lock.read()):
+        yield
+
+# Function to run a blocking sheet function in a thread while holding the ledger lock
+async def run_ledger(lock, access, func, *args, **kwargs):
+    async with ledger_access(lock, access):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+# Function to read the version of a sheet row (rows logged before versioning count as version 0)
+def row_version(row):
+    try:
+        return int(row[VERSION_COL])
+    except (IndexError, ValueError):
+        return 0
+
+# Function to make sure the version column has a header so get_all_records keeps working (must hold the write lock)
+def ensure_version_header(worksheet):
+    if not worksheet.cell(1, VERSION_COL + 1).value:
+        worksheet.update_cell(1, VERSION_COL + 1, "Version")
+
+# Function to find a receipt row by serial number or payment date (YYYY-MM-DD)
+def find_receipt(worksheet, serial_number=None, payment_date=None):
+    for row in worksheet.get_all_values()[1:]:  # Skip the header
+        if serial_number is not None and row[SERIAL_NUMBER_COL] == str(serial_number):
+            return row
+        if payment_date is not None and row[PAYMENT_DATE_COL] == payment_date:
+            return row
+    return None
+
+# Function to describe a receipt for !show_receipt, looked up by serial number or a DD/MM/YYYY payment date
+def describe_receipt(worksheet, identifier):
+    # Attempt to treat the identifier as a serial number, then as a date
+    try:
+        serial_number = int(identifier)
+        row = find_receipt(worksheet, serial_number=serial_number)
+        if row is None:
+            return f"No receipt found with serial number {serial_number}."
+    except ValueError:
+        try:
+            payment_date = datetime.strptime(identifier, '%d/%m/%Y').strftime('%Y-%m-%d')
+        except ValueError:
+            return "Invalid input. Please provide a valid serial number or a date in DD/MM/YYYY format."
+        row = find_receipt(worksheet, payment_date=payment_date)
+        if row is None:
+            return f"No receipt found for {payment_date}."
+    return f"Receipt for {row[PAID_BY_COL]}: Serial Number: {row[SERIAL_NUMBER_COL]}, Payment Date: {row[PAYMENT_DATE_COL]}, Amount: {row[AMOUNT_COL]}"
+
+# Function to get the current sheet row number of a receipt, checking it still has the version that was read
+def locate_receipt_row(worksheet, serial_number, expected_version):
+    for row_number, row in enumerate(worksheet.get_all_values()[1:], start=2):  # Start from 2 because row 1 is the header
+        if row[SERIAL_NUMBER_COL] == str(serial_number):
+            if row_version(row) != expected_version:
+                raise LedgerConflict(f"Receipt with serial number {serial_number} was changed by another command.")
+            return row_number
+    raise LedgerConflict(f"Receipt with serial number {serial_number} was deleted by another command.")
+
+# Function to append a receipt with the next free serial number and version 1 (must hold the write lock)
+# `values` are the columns after the serial number; returns the new serial number.
+def append_receipt(worksheet, values):
+    serial_numbers = [int(row[SERIAL_NUMBER_COL]) for row in worksheet.get_all_values()[1:] if row[SERIAL_NUMBER_COL].isdigit()]
+    serial_number = max(serial_numbers, default=0) + 1
+    worksheet.append_row([serial_number] + list(values) + [1])
+    return serial_number
+
+# Function to change a receipt's amount (must hold the write lock)
+# The amount and version are written in one batch_update so a failure can't leave a new amount on an old version.
+def update_receipt_amount(worksheet, serial_number, expected_version, new_amount):
+    row_number = locate_receipt_row(worksheet, serial_number, expected_version)
+    worksheet.batch_update([
+        {'range': f"{column_letter(AMOUNT_COL)}{row_number}", 'values': [[new_amount]]},
+        {'range': f"{column_letter(VERSION_COL)}{row_number}", 'values': [[expected_version + 1]]},
+    ])
+
+# Function to delete a receipt (must hold the write lock)
+def delete_receipt_row(worksheet, serial_number, expected_version):
+    worksheet.delete_rows(locate_receipt_row(worksheet, serial_number, expected_version))
+
+# Function to rename the payer on a batch of receipts in one batch_update (must hold the write lock)
+# `renames` is a list of (serial number, version read, new name); receipts that were changed or deleted
+# since they were read are skipped. Returns (renamed, skipped).
+def rename_payers(worksheet, renames):
+    rows = {row[SERIAL_NUMBER_COL]: (row_number, row) for row_number, row in enumerate(worksheet.get_all_values()[1:], start=2)}
+    updates = []
+    for serial_number, expected_version, new_name in renames:
+        if serial_number not in rows or row_version(rows[serial_number][1]) != expected_version:
+            continue
+        row_number = rows[serial_number][0]
+        updates.append({'range': f"{column_letter(PAID_BY_COL)}{row_number}", 'values': [[new_name]]})
+        updates.append({'range': f"{column_letter(VERSION_COL)}{row_number}", 'values': [[expected_version + 1]]})
+    if updates:
+        worksheet.batch_update(updates)
+    renamed = len(updates) // 2
+    return renamed, len(renames) - renamed
+
+# Function to turn a column index into its A1 letter (the ledger only uses columns A-Z)
+def column_letter(col):
+    return chr(ord('A') + col)
+
+# Function to apply a change to the current version of a receipt (must hold the write lock)
+def change_current_receipt(worksheet, change, args, serial_number):
+    row = find_receipt(worksheet, serial_number=serial_number)
+    if row is None:
+        raise LedgerConflict(f"Receipt with serial number {serial_number} was already deleted by another command.")
+    change(worksheet, row[SERIAL_NUMBER_COL], row_version(row), *args)
+
+# Function to apply a change to a receipt by serial number
+# The receipt is read under the read lock, then `change` runs under the write lock against that serial number.
+# If the row changed in between, LedgerConflict is raised so the caller can tell the user; with `retry`, the
+# change is instead applied once more under the write lock to whatever that receipt now holds (never to
+# another receipt with the same date). Returns the serial number, or None if no receipt matched.
+async def change_receipt(lock, worksheet, change, args=(), serial_number=None, payment_date=None, retry=False):
+    row = await run_ledger(lock, 'read', find_receipt, worksheet, serial_number=serial_number, payment_date=payment_date)
+    if row is None:
+        return None
+    serial_number = row[SERIAL_NUMBER_COL]
+    try:
+        await run_ledger(lock, 'write', change, worksheet, serial_number, row_version(row), *args)
+        return serial_number
+    except LedgerConflict as e:
+        if not retry:
+            raise
+        logging.info(f"Retrying after conflict: {str(e)}")
+    await run_ledger(lock, 'write', change_current_receipt, worksheet, change, args, serial_number)
+    return serial_number
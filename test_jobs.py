@@ -0,0 +1,146 @@
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import jobs
+
+
+# Stand-in for a Discord message that records every edit
+class FakeMessage:
+    def __init__(self, content):
+        self.contents = [content]
+
+    async def edit(self, content):
+        self.contents.append(content)
+
+
+# Stand-in for a command context that records every message sent to the channel
+class FakeContext:
+    def __init__(self, fail_sends=False):
+        self.message = type("Message", (), {"content": "!request_report"})
+        self.sent = []
+        self.fail_sends = fail_sends
+
+    async def send(self, content):
+        if self.fail_sends:
+            raise RuntimeError("send failed")
+        message = FakeMessage(content)
+        self.sent.append(message)
+        return message
+
+
+def make_queue(maxsize, workers=1):
+    return jobs.JobQueue(workers, maxsize, ThreadPoolExecutor(max_workers=workers))
+
+
+def test_full_queue_refuses_jobs_without_using_job_ids():
+    async def run():
+        job_queue = make_queue(maxsize=1)
+        ctx = FakeContext()
+        release = threading.Event()
+
+        def job(name, progress):
+            release.wait(5)
+            return name
+
+        assert await job_queue.submit(ctx, "first", job, "first") == 1
+        assert await job_queue.submit(ctx, "second", job, "second") is None
+        assert ctx.sent[-1].contents == ["The bot is busy with 1 queued jobs. Please try `!request_report` again shortly."]
+
+        # Once the queue drains, the next job gets the next unused ID
+        job_queue.start()
+        release.set()
+        await job_queue.join()
+        assert await job_queue.submit(ctx, "third", job, "third") == 2
+        await job_queue.join()
+
+    asyncio.run(run())
+
+
+def test_concurrent_submissions_never_overfill_the_queue():
+    async def run():
+        job_queue = make_queue(maxsize=2)
+        ctx = FakeContext()
+
+        # Each submit awaits ctx.send, so these interleave; only two may get a slot
+        results = await asyncio.gather(*(job_queue.submit(ctx, f"job {i}", lambda progress: "ok") for i in range(5)))
+
+        assert sorted(result for result in results if result is not None) == [1, 2]
+        assert results.count(None) == 3
+        assert job_queue._queue.qsize() == 2
+
+    asyncio.run(run())
+
+
+def test_progress_edits_land_before_the_final_status():
+    async def run():
+        job_queue = make_queue(maxsize=5)
+        ctx = FakeContext()
+        job_queue.start()
+
+        def job(progress):
+            for step in range(1, 4):
+                progress(f"step {step}")
+                time.sleep(0.01)
+            return "report"
+
+        job_id = await job_queue.submit(ctx, "generating report", job)
+        await job_queue.join()
+
+        status, result = ctx.sent
+        assert status.contents == [
+            f"Job #{job_id} queued: generating report (position 1).",
+            f"Job #{job_id} running: generating report...",
+            f"Job #{job_id} running: step 1",
+            f"Job #{job_id} running: step 2",
+            f"Job #{job_id} running: step 3",
+            f"Job #{job_id} done: generating report.",
+        ]
+        assert result.contents == ["report"]
+
+    asyncio.run(run())
+
+
+def test_failed_job_reports_the_error_and_the_worker_keeps_going():
+    async def run():
+        job_queue = make_queue(maxsize=5)
+        ctx = FakeContext()
+        delivered = []
+        job_queue.start()
+
+        async def deliver(result):
+            delivered.append(result)
+
+        def failing_job(progress):
+            raise ValueError("sheet unavailable")
+
+        await job_queue.submit(ctx, "exporting receipts", failing_job, deliver=deliver)
+        await job_queue.submit(ctx, "generating report", lambda progress: "report", deliver=deliver)
+        await job_queue.join()
+
+        assert ctx.sent[0].contents[-1] == "Job #1 failed: sheet unavailable"
+        assert ctx.sent[1].contents[-1] == "Job #2 done: generating report."
+        assert delivered == ["report"]
+
+    asyncio.run(run())
+
+
+def test_job_is_dropped_when_its_status_message_cannot_be_sent():
+    async def run():
+        job_queue = make_queue(maxsize=5)
+        ran = []
+        job_queue.start()
+
+        try:
+            await job_queue.submit(FakeContext(fail_sends=True), "asking Claude", lambda progress: ran.append(True))
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("submit swallowed the send failure")
+        await job_queue.join()
+
+        assert ran == []
+
+    asyncio.run(run())
@@ -0,0 +1,266 @@
+
+import asyncio
+import threading
+import time
+
+import ledger
+
+
+LATENCY = 0.01  # Simulated Google Sheets round-trip in seconds
+
+# In-memory stand-in for a gspread worksheet, with a delay on every API call
+class FakeWorksheet:
+    def __init__(self):
+        self.rows = [["Serial Number", "Paid By", "Payment Date", "Amount", "Log Date", "Cover Date", "Next Rent Date", "Version"]]
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _api_call(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(LATENCY)
+
+    def get_all_values(self):
+        self._api_call()
+        with self._lock:
+            return [list(row) + [""] * (8 - len(row)) for row in self.rows]
+
+    def append_row(self, values):
+        self._api_call()
+        with self._lock:
+            self.rows.append([str(value) for value in values])
+
+    def update_cell(self, row, col, value):
+        self._api_call()
+        with self._lock:
+            self.rows[row - 1][col - 1] = str(value)
+
+    def delete_rows(self, index):
+        self._api_call()
+        with self._lock:
+            del self.rows[index - 1]
+
+    def batch_update(self, data):
+        self._api_call()
+        with self._lock:
+            for update in data:
+                col, row = ord(update['range'][0]) - ord('A'), int(update['range'][1:])
+                self.rows[row - 1][col] = str(update['values'][0][0])
+
+    def cell(self, row, col):
+        self._api_call()
+        with self._lock:
+            value = self.rows[row - 1][col - 1] if col <= len(self.rows[row - 1]) else ""
+        return type("Cell", (), {"value": value})
+
+    def receipts(self):
+        return {row[0]: row for row in self.rows[1:]}
+
+
+def receipt_values(i):
+    return [f"user{i}", "2024-02-12", "$100.00", "2024-02-12", "2024-01-29", "2024-02-26"]
+
+
+async def append_receipts(lock, worksheet, count):
+    return await asyncio.gather(*(
+        ledger.run_ledger(lock, 'write', ledger.append_receipt, worksheet, receipt_values(i)) for i in range(count)
+    ))
+
+
+def test_concurrent_appends_get_unique_serials():
+    async def run():
+        lock = ledger.ReadWriteLock()
+        worksheet = FakeWorksheet()
+        serial_numbers = await append_receipts(lock, worksheet, 30)
+        assert sorted(serial_numbers) == list(range(1, 31))
+        assert sorted(worksheet.receipts(), key=int) == [str(i) for i in range(1, 31)]
+        assert all(row[ledger.VERSION_COL] == "1" for row in worksheet.receipts().values())
+
+    asyncio.run(run())
+
+
+def test_readers_share_the_lock_and_writers_do_not():
+    async def run():
+        lock = ledger.ReadWriteLock()
+        active = {'readers': 0, 'max_readers': 0, 'writers': 0}
+
+        async def reader():
+            async with lock.read():
+                assert active['writers'] == 0
+                active['readers'] += 1
+                active['max_readers'] = max(active['max_readers'], active['readers'])
+                await asyncio.sleep(0.01)
+                active['readers'] -= 1
+
+        async def writer():
+            async with lock.write():
+                assert active['readers'] == 0 and active['writers'] == 0
+                active['writers'] += 1
+                await asyncio.sleep(0.01)
+                active['writers'] -= 1
+
+        await asyncio.gather(*[reader() for _ in range(10)], *[writer() for _ in range(3)], *[reader() for _ in range(10)])
+        assert active['max_readers'] > 1
+
+    asyncio.run(run())
+
+
+def test_stress_concurrent_edits_deletes_and_reads():
+    async def run():
+        lock = ledger.ReadWriteLock()
+        worksheet = FakeWorksheet()
+        await append_receipts(lock, worksheet, 40)
+        worksheet.calls = 0
+
+        async def edit(serial_number):
+            return await ledger.change_receipt(lock, worksheet, ledger.update_receipt_amount, (serial_number * 10.0,), serial_number=serial_number)
+
+        async def delete(serial_number):
+            return await ledger.change_receipt(lock, worksheet, ledger.delete_receipt_row, serial_number=serial_number)
+
+        async def read(serial_number):
+            return await ledger.run_ledger(lock, 'read', ledger.find_receipt, worksheet, serial_number=serial_number)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *[edit(i) for i in range(1, 11)],
+            *[delete(i) for i in range(21, 41)],
+            *[read(i % 20 + 1) for i in range(100)],
+        )
+        elapsed = time.perf_counter() - start
+
+        # Every edit and delete found its receipt, and every read saw a receipt that was never deleted
+        assert results[:30] == [str(i) for i in range(1, 11)] + [str(i) for i in range(21, 41)]
+        assert all(row is not None for row in results[30:])
+
+        # No lost updates: exactly the deleted rows are gone and every edit landed once
+        receipts = worksheet.receipts()
+        assert len(worksheet.rows) == 1 + 20
+        assert sorted(receipts, key=int) == [str(i) for i in range(1, 21)]
+        for i in range(1, 11):
+            assert receipts[str(i)][ledger.AMOUNT_COL] == str(i * 10.0)
+            assert receipts[str(i)][ledger.VERSION_COL] == "2"
+        for i in range(11, 21):
+            assert receipts[str(i)][ledger.AMOUNT_COL] == "$100.00"
+            assert receipts[str(i)][ledger.VERSION_COL] == "1"
+
+        # Throughput holds: reads run in parallel, so the run takes well under one round-trip per API call
+        assert elapsed < worksheet.calls * LATENCY * 0.75
+
+    asyncio.run(run())
+
+
+def test_concurrent_date_deletes_never_target_another_receipt():
+    async def run():
+        lock = ledger.ReadWriteLock()
+        worksheet = FakeWorksheet()
+        await append_receipts(lock, worksheet, 3)  # All dated 2024-02-12
+
+        results = await asyncio.gather(*(
+            ledger.change_receipt(lock, worksheet, ledger.delete_receipt_row, payment_date="2024-02-12", retry=True)
+            for _ in range(2)
+        ), return_exceptions=True)
+
+        # Both read serial 1: one deletes it, the other is told it was already deleted
+        assert "1" in results
+        conflict = [result for result in results if isinstance(result, ledger.LedgerConflict)]
+        assert len(conflict) == 1 and "already deleted" in str(conflict[0])
+        assert sorted(worksheet.receipts(), key=int) == ["2", "3"]
+
+    asyncio.run(run())
+
+
+def test_concurrent_edits_to_one_receipt_surface_conflicts():
+    async def run():
+        lock = ledger.ReadWriteLock()
+        worksheet = FakeWorksheet()
+        await append_receipts(lock, worksheet, 1)
+
+        results = await asyncio.gather(*(
+            ledger.change_receipt(lock, worksheet, ledger.update_receipt_amount, (amount,), serial_number=1)
+            for amount in (10.0, 20.0, 30.0, 40.0, 50.0)
+        ), return_exceptions=True)
+
+        # Edits that lost the race are reported, not silently applied over the winner
+        applied = [amount for amount, result in zip((10.0, 20.0, 30.0, 40.0, 50.0), results) if result == "1"]
+        conflicts = [result for result in results if isinstance(result, ledger.LedgerConflict)]
+        assert len(applied) + len(conflicts) == 5
+        assert conflicts and all("changed by another command" in str(conflict) for conflict in conflicts)
+
+        receipt = worksheet.receipts()["1"]
+        assert receipt[ledger.VERSION_COL] == str(1 + len(applied))
+        assert receipt[ledger.AMOUNT_COL] in [str(amount) for amount in applied]
+
+    asyncio.run(run())
+
+
+def test_rename_payers_skips_receipts_changed_since_read():
+    async def run():
+        lock = ledger.ReadWriteLock()
+        worksheet = FakeWorksheet()
+        await append_receipts(lock, worksheet, 4)
+        renames = [(str(i), 1, "NewName") for i in range(1, 5)]
+
+        # Receipt 2 is edited and receipt 3 deleted after the renames were read
+        await ledger.change_receipt(lock, worksheet, ledger.update_receipt_amount, (5.0,), serial_number=2)
+        await ledger.change_receipt(lock, worksheet, ledger.delete_receipt_row, serial_number=3)
+        calls = worksheet.calls
+        result = await ledger.run_ledger(lock, 'write', ledger.rename_payers, worksheet, renames)
+
+        assert result == (2, 2)
+        assert worksheet.calls - calls == 2  # One read and one batch_update
+        receipts = worksheet.receipts()
+        assert [receipts[serial][ledger.PAID_BY_COL] for serial in ("1", "2", "4")] == ["NewName", "user1", "NewName"]
+        assert [receipts[serial][ledger.VERSION_COL] for serial in ("1", "2", "4")] == ["2", "2", "2"]
+        assert receipts["2"][ledger.AMOUNT_COL] == "5.0"
+
+    asyncio.run(run())
+
+
+def test_describe_receipt_by_serial_number_and_date():
+    async def run():
+        lock = ledger.ReadWriteLock()
+        worksheet = FakeWorksheet()
+        await append_receipts(lock, worksheet, 2)
+
+        def describe(identifier):
+            return ledger.describe_receipt(worksheet, identifier)
+
+        assert describe("2") == "Receipt for user1: Serial Number: 2, Payment Date: 2024-02-12, Amount: $100.00"
+        assert describe("12/02/2024") == "Receipt for user0: Serial Number: 1, Payment Date: 2024-02-12, Amount: $100.00"
+        assert describe("3") == "No receipt found with serial number 3."
+        assert describe("13/02/2024") == "No receipt found for 2024-02-13."
+        assert describe("yesterday").startswith("Invalid input.")
+
+    asyncio.run(run())
+
+
+def test_amount_and_version_are_written_in_one_call():
+    async def run():
+        lock = ledger.ReadWriteLock()
+        worksheet = FakeWorksheet()
+        await append_receipts(lock, worksheet, 1)
+
+        # A worksheet whose single-cell writes always fail, so only batch_update can apply the edit
+        def fail_update_cell(row, col, value):
+            raise AssertionError("update_cell must not be used for edits")
+        worksheet.update_cell = fail_update_cell
+
+        await ledger.change_receipt(lock, worksheet, ledger.update_receipt_amount, (75.0,), serial_number=1)
+        receipt = worksheet.receipts()["1"]
+        assert (receipt[ledger.AMOUNT_COL], receipt[ledger.VERSION_COL]) == ("75.0", "2")
+
+    asyncio.run(run())
+
+
+def test_unknown_ledger_access_is_rejected():
+    async def run():
+        lock = ledger.ReadWriteLock()
+        try:
+            await ledger.run_ledger(lock, 'raed', FakeWorksheet().get_all_values)
+        except ValueError as e:
+            assert "'raed'" in str(e)
+        else:
+            raise AssertionError("run_ledger accepted an unknown access level")
+
+    asyncio.run(run())